@@ -4,6 +4,7 @@ from google.genai import types  # Para criar conteúdos (Content e Part)
 from dotenv import load_dotenv
 from IPython.display import display, HTML, Markdown # Para exibir texto formatado no Colab
 from google.adk.agents import Agent
+from google.adk.events import Event
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 from google.adk.tools import google_search
@@ -11,30 +12,325 @@ from datetime import date
 import textwrap # Para formatar melhor a saída de texto
 import requests # Para fazer requisições HTTP
 import warnings
+import gzip # Para compactar os cassetes de gravação
+import hashlib
+import json
+import tempfile
+import time
+import uuid
+import atexit
+import contextlib
+import contextvars
+import functools
+import threading
+import ast
+import ctypes
+import ctypes.util
+import select
+import struct
+import html
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Literal, Optional
+from pydantic import BaseModel, Field # Para a saída estruturada dos especialistas
 
 # --- Configura API do Gemini ---
 load_dotenv()
+
+# --- Configura gravação/reprodução das chamadas aos agentes (cassetes) ---
+# CASSETTE_MODE: "record" grava cada chamada, "replay" reproduz sem acessar o Gemini
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").strip().lower()
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", "cassetes")
+# 1.0 = tempo original, 2.0 = duas vezes mais rápido, 0 = sem esperas
+CASSETTE_VELOCIDADE = float(os.getenv("CASSETTE_VELOCIDADE", "1.0"))
+
+# --- Configura o rastreamento (trace) da revisão ---
+# Quando definido, grava a linha do tempo no formato Chrome Trace (abre no Perfetto / chrome://tracing)
+TRACE_ARQUIVO = os.getenv("TRACE_ARQUIVO")
+
+# --- Configura o agendamento das chamadas ao modelo ---
+MODELO_CONCORRENCIA = int(os.getenv("MODELO_CONCORRENCIA", "8"))  # chamadas simultâneas ao modelo
+MODELO_RPM = int(os.getenv("MODELO_RPM", "0"))  # chamadas por minuto (0 = sem limite)
+RESERVA_INTERATIVA = int(os.getenv("RESERVA_INTERATIVA", "1"))  # vagas que o lote não pode ocupar
+TENANT = os.getenv("TENANT", "padrao")
+PESOS_TENANT = os.getenv("PESOS_TENANT", "")  # ex: "time-a=2,time-b=1"
+COTAS_TENANT = os.getenv("COTAS_TENANT", "")  # ex: "time-a=4" (máx. de chamadas simultâneas)
+COTA_PADRAO_TENANT = int(os.getenv("COTA_PADRAO_TENANT", "0"))  # 0 = sem cota
+# Com SERVIDOR_URL as revisões são enviadas a um servidor (SERVIDOR_PORTA) que concentra
+# o agendamento de todos os processos, em vez de chamar o modelo localmente
+SERVIDOR_URL = os.getenv("SERVIDOR_URL", "").rstrip("/")
+SERVIDOR_TIMEOUT = float(os.getenv("SERVIDOR_TIMEOUT", "600"))
+
 api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
+if not api_key and CASSETTE_MODE != "replay" and not SERVIDOR_URL:
     print("Erro: API Key do Gemini não encontrada. Defina GEMINI_API_KEY no seu arquivo .env")
     exit()
 print("API Key do Gemini configurada com sucesso.")
 
-# --- Configura o cliente da SDK do Gemini ---
-client = genai.Client(
-    vertexai=True, project=os.getenv("PROJECT_ID"), location='us-central1'
-)
 MODEL_ID = "gemini-2.0-flash"
+# No modo replay (ou como cliente do servidor) nenhuma chamada é feita ao Gemini
+if CASSETTE_MODE != "replay" and not SERVIDOR_URL:
+    # --- Configura o cliente da SDK do Gemini ---
+    client = genai.Client(
+        vertexai=True, project=os.getenv("PROJECT_ID"), location='us-central1'
+    )
 
-# Pergunta ao Gemini uma informação utilizando a busca do Google como contexto
-response = client.models.generate_content(
-    model=MODEL_ID,
-    contents='Faça uma introdução sucinta a programação.',
-    config={"tools": [{"google_search": {}}]}
-)
+    # Pergunta ao Gemini uma informação utilizando a busca do Google como contexto
+    response = client.models.generate_content(
+        model=MODEL_ID,
+        contents='Faça uma introdução sucinta a programação.',
+        config={"tools": [{"google_search": {}}]}
+    )
+
+    # Exibe a resposta na tela
+    display(Markdown(f"Resposta:\n {response.text}"))
+
+
+####
+# --- Rastreamento: spans no formato Chrome Trace (Perfetto / chrome://tracing) ---
+# Com TRACE_ARQUIVO vazio, span() devolve um contexto nulo e rastreado() não
+# embrulha a função, então o custo com o rastreamento desligado é desprezível.
+_trace_eventos = []
+_trace_threads = set()
+_trace_lock = threading.Lock()
+_SPAN_NULO = contextlib.nullcontext()
+
+# Converte perf_counter (segundos) para microssegundos, a unidade do Chrome Trace
+def _trace_us(instante):
+    return round(instante * 1_000_000, 1)
+
+# Registra um intervalo já medido (evento "X" do Chrome Trace)
+def registrar_span(nome, inicio, fim, cat="revisao", args=None):
+    tid = threading.get_ident()
+    evento = {
+        "name": nome, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": tid,
+        "ts": _trace_us(inicio), "dur": _trace_us(fim - inicio), "args": args or {},
+    }
+    with _trace_lock:
+        if tid not in _trace_threads:
+            _trace_threads.add(tid)
+            _trace_eventos.append({
+                "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                "args": {"name": threading.current_thread().name},
+            })
+        _trace_eventos.append(evento)
+
+@contextlib.contextmanager
+def _span_ativo(nome, cat, args):
+    inicio = time.perf_counter()
+    try:
+        yield args
+    finally:
+        registrar_span(nome, inicio, time.perf_counter(), cat, args)
+
+# Mede o bloco dentro do "with"; o dicionário devolvido pode receber mais argumentos
+def span(nome, cat="revisao", **args):
+    if not TRACE_ARQUIVO:
+        return _SPAN_NULO
+    return _span_ativo(nome, cat, args)
+
+# Decorador que mede cada chamada da função
+def rastreado(nome, cat="revisao"):
+    def decorador(funcao):
+        if not TRACE_ARQUIVO:
+            return funcao
+        @functools.wraps(funcao)
+        def embrulho(*args, **kwargs):
+            with _span_ativo(nome, cat, {}):
+                return funcao(*args, **kwargs)
+        return embrulho
+    return decorador
+
+# Mede o intervalo até a chegada de cada evento do Runner: o primeiro intervalo é o
+# tempo até o primeiro token, e um intervalo que termina numa resposta de ferramenta
+# é a ida e volta de uma ferramenta executada localmente (function calling).
+# O google_search é uma ferramenta nativa executada no servidor do Gemini: não gera
+# eventos próprios, então o tempo da busca fica dentro do span "modelo" e não pode
+# ser separado dele; as consultas feitas aparecem no argumento "google_search".
+def rastrear_eventos(agent: Agent, eventos):
+    anterior = time.perf_counter()
+    primeiro = True
+    for event in eventos:
+        agora = time.perf_counter()
+        chamadas = [chamada.name for chamada in event.get_function_calls()]
+        respostas = [resposta.name for resposta in event.get_function_responses()]
+        if respostas:
+            nome = "ferramenta: " + ", ".join(respostas)
+        elif primeiro:
+            nome = "modelo: primeiro evento"
+        else:
+            nome = "modelo"
+        args = {"agente": agent.name, "final": event.is_final_response()}
+        if chamadas:
+            args["chamadas"] = chamadas
+        if event.grounding_metadata and event.grounding_metadata.web_search_queries:
+            args["google_search"] = event.grounding_metadata.web_search_queries
+            nome += " (com google_search no servidor)"
+        if event.usage_metadata:
+            args["tokens_entrada"] = event.usage_metadata.prompt_token_count
+            args["tokens_saida"] = event.usage_metadata.candidates_token_count
+        registrar_span(nome, anterior, agora, cat="evento", args=args)
+        primeiro = False
+        yield event
+        anterior = time.perf_counter()
+
+def exportar_trace():
+    with _trace_lock:
+        eventos = list(_trace_eventos)
+    with open(TRACE_ARQUIVO, "w", encoding="utf-8") as arquivo:
+        json.dump({"traceEvents": eventos, "displayTimeUnit": "ms"}, arquivo, ensure_ascii=False)
+    print(f"Trace salvo em {TRACE_ARQUIVO} ({len(eventos)} eventos)")
+
+if TRACE_ARQUIVO:
+    atexit.register(exportar_trace)
+####
 
-# Exibe a resposta na tela
-display(Markdown(f"Resposta:\n {response.text}"))
+
+####
+# --- Agendamento justo das chamadas ao modelo ---
+# Toda chamada ao call_agent ocupa uma vaga do limite compartilhado do modelo.
+# A classe "interativo" tem prioridade sobre "lote" e conta com vagas reservadas;
+# dentro de cada classe os tenants são atendidos por fila justa ponderada
+# (start-time fair queuing) e respeitam suas cotas de chamadas simultâneas.
+CLASSES_PRIORIDADE = ["interativo", "lote"]
+JOB_ATUAL = contextvars.ContextVar("job_atual", default=(TENANT, "interativo"))
+
+# Define o tenant e a classe das chamadas feitas dentro do "with"
+@contextlib.contextmanager
+def job(tenant=TENANT, classe="interativo"):
+    token = JOB_ATUAL.set((tenant, classe))
+    try:
+        yield
+    finally:
+        JOB_ATUAL.reset(token)
+
+# Converte "a=2,b=1" em {"a": 2.0, "b": 1.0}
+def ler_mapa(valor):
+    mapa = {}
+    for item in valor.split(","):
+        if "=" in item:
+            chave, numero = item.split("=", 1)
+            mapa[chave.strip()] = float(numero)
+    return mapa
+
+class AgendadorJusto:
+    def __init__(self, concorrencia, reserva_interativa=0, requisicoes_por_minuto=0, pesos=None, cotas=None, cota_padrao=0):
+        self.concorrencia = max(1, concorrencia)
+        self.reserva_interativa = max(0, min(reserva_interativa, self.concorrencia - 1))
+        self.intervalo_minimo = 60 / requisicoes_por_minuto if requisicoes_por_minuto > 0 else 0
+        self.pesos = pesos or {}
+        self.cotas = cotas or {}
+        self.cota_padrao = cota_padrao
+        self.condicao = threading.Condition()
+        self.em_uso = {classe: 0 for classe in CLASSES_PRIORIDADE}
+        self.em_uso_por_tenant = {}
+        self.filas = {classe: {} for classe in CLASSES_PRIORIDADE}
+        self.tempo_virtual = {classe: 0.0 for classe in CLASSES_PRIORIDADE}
+        self.ultimo_termino = {}
+        self.proxima_liberacao = 0.0
+        self.esperas = {classe: deque(maxlen=10000) for classe in CLASSES_PRIORIDADE}
+        self.total = {classe: 0 for classe in CLASSES_PRIORIDADE}
+
+    def _cabe(self, classe, tenant):
+        if sum(self.em_uso.values()) >= self.concorrencia:
+            return False
+        if classe != "interativo" and self.em_uso[classe] >= self.concorrencia - self.reserva_interativa:
+            return False
+        cota = self.cotas.get(tenant, self.cota_padrao)
+        return not cota or self.em_uso_por_tenant.get(tenant, 0) < cota
+
+    # Libera os pedidos que cabem agora: a classe mais prioritária primeiro e, dentro
+    # dela, o tenant com menor tempo virtual de término
+    def _despachar(self):
+        while True:
+            agora = time.monotonic()
+            if self.intervalo_minimo and agora < self.proxima_liberacao:
+                return
+            escolhido = None
+            for classe in CLASSES_PRIORIDADE:
+                candidatos = [(fila[0]["termino"], tenant) for tenant, fila in self.filas[classe].items()
+                              if fila and self._cabe(classe, tenant)]
+                if candidatos:
+                    escolhido = classe, min(candidatos)[1]
+                    break
+            if escolhido is None:
+                return
+            classe, tenant = escolhido
+            pedido = self.filas[classe][tenant].popleft()
+            if not self.filas[classe][tenant]:
+                del self.filas[classe][tenant]
+            self.tempo_virtual[classe] = pedido["inicio"]
+            self.em_uso[classe] += 1
+            self.em_uso_por_tenant[tenant] = self.em_uso_por_tenant.get(tenant, 0) + 1
+            if self.intervalo_minimo:
+                self.proxima_liberacao = max(agora, self.proxima_liberacao) + self.intervalo_minimo
+            pedido["liberado"] = True
+            self.condicao.notify_all()
+
+    # Se o que segura a fila é o limite de taxa, quem espera acorda sozinho quando ele
+    # libera; se são as vagas ocupadas, espera o notify_all de quem terminar
+    def _tempo_ate_liberar(self):
+        if not self.intervalo_minimo:
+            return None
+        restante = self.proxima_liberacao - time.monotonic()
+        return restante if restante > 0 else None
+
+    # Espera a vez do job atual (ver job()) e ocupa uma vaga até o fim do "with"
+    @contextlib.contextmanager
+    def vaga(self, custo=1.0):
+        tenant, classe = JOB_ATUAL.get()
+        chegada = time.perf_counter()
+        with self.condicao:
+            inicio = max(self.tempo_virtual[classe], self.ultimo_termino.get((classe, tenant), 0.0))
+            pedido = {"liberado": False, "inicio": inicio, "termino": inicio + custo / self.pesos.get(tenant, 1.0)}
+            self.ultimo_termino[(classe, tenant)] = pedido["termino"]
+            self.filas[classe].setdefault(tenant, deque()).append(pedido)
+            while True:
+                self._despachar()
+                if pedido["liberado"]:
+                    break
+                self.condicao.wait(self._tempo_ate_liberar())
+            espera = time.perf_counter() - chegada
+            self.esperas[classe].append(espera)
+            self.total[classe] += 1
+        if TRACE_ARQUIVO:
+            registrar_span(f"fila: {classe}", chegada, chegada + espera, cat="fila", args={"tenant": tenant})
+        try:
+            yield
+        finally:
+            with self.condicao:
+                self.em_uso[classe] -= 1
+                self.em_uso_por_tenant[tenant] -= 1
+                self._despachar()
+
+    # Tempo de espera na fila por classe (p50/p95/máx das últimas 10 mil chamadas)
+    def estatisticas(self):
+        with self.condicao:
+            esperas = {classe: list(self.esperas[classe]) for classe in CLASSES_PRIORIDADE}
+            total = dict(self.total)
+            em_uso = dict(self.em_uso)
+        return {classe: {"chamadas": total[classe], "em_uso": em_uso[classe], "p50": percentil(esperas[classe], 50),
+                         "p95": percentil(esperas[classe], 95), "max": max(esperas[classe], default=0.0)}
+                for classe in CLASSES_PRIORIDADE}
+
+    def relatorio(self):
+        return "\n".join(
+            f"Fila {classe}: {dados['chamadas']} chamadas | espera p50: {dados['p50']:.2f}s "
+            f"| p95: {dados['p95']:.2f}s | máx: {dados['max']:.2f}s"
+            for classe, dados in self.estatisticas().items() if dados["chamadas"]
+        )
+
+AGENDADOR = AgendadorJusto(
+    MODELO_CONCORRENCIA,
+    reserva_interativa=RESERVA_INTERATIVA,
+    requisicoes_por_minuto=MODELO_RPM,
+    pesos=ler_mapa(PESOS_TENANT),
+    cotas={tenant: int(cota) for tenant, cota in ler_mapa(COTAS_TENANT).items()},
+    cota_padrao=COTA_PADRAO_TENANT,
+)
+####
 
 
 ####
@@ -42,38 +338,160 @@ display(Markdown(f"Resposta:\n {response.text}"))
 warnings.filterwarnings("ignore")
 # Função auxiliar que envia uma mensagem para um agente via Runner e retorna a resposta final
 def call_agent(agent: Agent, message_text: str) -> str:
-    # Cria um serviço de sessão em memória
-    session_service = InMemorySessionService()
-    # Cria uma nova sessão (você pode personalizar os IDs conforme necessário)
-    session = session_service.create_session(app_name=agent.name, user_id="user1", session_id="session1")
-    # Cria um Runner para o agente
-    runner = Runner(agent=agent, app_name=agent.name, session_service=session_service)
-    # Cria o conteúdo da mensagem de entrada
-    content = types.Content(role="user", parts=[types.Part(text=message_text)])
-
-    final_response = ""
-    # Itera assincronamente pelos eventos retornados durante a execução do agente
-    for event in runner.run(user_id="user1", session_id="session1", new_message=content):
-        if event.is_final_response():
-          for part in event.content.parts:
-            if part.text is not None:
-              final_response += part.text
-              final_response += "\n"
-    return final_response
+    with span(f"call_agent: {agent.name}", cat="agente", agente=agent.name), AGENDADOR.vaga():
+        chave = chave_cassete(agent, message_text)
+        if CASSETTE_MODE == "replay":
+            # Reproduz os eventos gravados, sem acessar o Gemini
+            eventos = reproduzir_cassete(agent, chave)
+        else:
+            with span("criar sessão", agente=agent.name):
+                # Cria um serviço de sessão em memória
+                session_service = InMemorySessionService()
+                # Cria uma nova sessão (você pode personalizar os IDs conforme necessário)
+                session = session_service.create_session(app_name=agent.name, user_id="user1", session_id="session1")
+                # Cria um Runner para o agente
+                runner = Runner(agent=agent, app_name=agent.name, session_service=session_service)
+            # Cria o conteúdo da mensagem de entrada
+            content = types.Content(role="user", parts=[types.Part(text=message_text)])
+            eventos = runner.run(user_id="user1", session_id="session1", new_message=content)
+            if CASSETTE_MODE == "record":
+                eventos = gravar_cassete(agent, chave, eventos)
+        if TRACE_ARQUIVO:
+            eventos = rastrear_eventos(agent, eventos)
+
+        final_response = ""
+        # Itera assincronamente pelos eventos retornados durante a execução do agente
+        for event in eventos:
+            if event.is_final_response():
+              for part in event.content.parts:
+                if part.text is not None:
+                  final_response += part.text
+                  final_response += "\n"
+        return final_response
 # Função auxiliar para exibir texto formatado em Markdown no Colab
+@rastreado("to_markdown")
 def to_markdown(text):
   text = text.replace('•', '  *')
   return Markdown(textwrap.indent(text, '> ', predicate=lambda _: True))
 ####
 
 
+####
+# --- Saída estruturada dos especialistas (usada na revisão em lote) ---
+# Com estruturado=True cada especialista responde no esquema abaixo (output_schema),
+# com um item por problema, em vez do relatório em texto livre.
+class ProblemaEncontrado(BaseModel):
+    linha: Optional[int] = Field(None, description="Linha do código onde está o problema (a primeira linha é 1)")
+    severidade: Literal["Alta", "Média", "Baixa"]
+    regra: str = Field(description="Identificador curto da regra, em kebab-case (ex: sql-injection)")
+    mensagem: str = Field(description="Diagnóstico e correção recomendada")
+
+class RelatorioEstruturado(BaseModel):
+    problemas: list[ProblemaEncontrado]
+
+# Numera as linhas do código para que o agente informe a linha correta de cada problema
+def entrada_estruturada(codigo):
+    linhas = "".join(f"{numero:>5} | {linha}" for numero, linha in enumerate(codigo.splitlines(keepends=True), 1))
+    return (
+        "Certo, vamos analisar esse código (as linhas estão numeradas):\n"
+        f"{linhas}\n\n"
+        "Responda SOMENTE no esquema JSON solicitado: um item em \"problemas\" para cada problema encontrado, "
+        "com a linha, a severidade (Alta/Média/Baixa), uma regra curta em kebab-case e a mensagem com o "
+        "diagnóstico e a correção. Se não houver problemas, devolva a lista vazia."
+    )
+####
+
+
+####
+# --- Cassetes: gravação e reprodução das chamadas aos agentes ---
+# Cada chamada ao call_agent vira um arquivo .json.gz com os eventos do Runner
+# (conteúdo, uso de tokens, metadados de busca) e o instante em que cada um chegou.
+# A chave considera o agente (nome, modelo, instrução) e a mensagem enviada.
+# Em CHEGADAS_ARQUIVO fica o instante de início de cada revisão, para reproduzir
+# depois o mesmo padrão de chegada (ver gerar_carga_aberta).
+CHEGADAS_ARQUIVO = os.path.join(CASSETTE_DIR, "chegadas.jsonl.gz")
+_chegadas_lock = threading.Lock()
+
+def chave_cassete(agent: Agent, message_text: str) -> str:
+    dados = "\0".join([agent.name, str(agent.model), str(agent.instruction), message_text])
+    return hashlib.sha256(dados.encode("utf-8")).hexdigest()
+
+def caminho_cassete(agent: Agent, chave: str) -> str:
+    return os.path.join(CASSETTE_DIR, f"{agent.name}-{chave[:16]}.json.gz")
+
+# Repassa os eventos para o call_agent e grava o cassete quando o Runner termina
+def gravar_cassete(agent: Agent, chave: str, eventos):
+    inicio = time.monotonic()
+    gravados = []
+    for event in eventos:
+        gravados.append({
+            "t": round(time.monotonic() - inicio, 4),
+            "evento": event.model_dump(mode="json", exclude_none=True, by_alias=True),
+        })
+        yield event
+    cassete = {
+        "agente": agent.name,
+        "chave": chave,
+        "gravado_em": date.today().isoformat(),
+        "duracao": round(time.monotonic() - inicio, 4),
+        "eventos": gravados,
+    }
+    os.makedirs(CASSETTE_DIR, exist_ok=True)
+    # Grava num arquivo temporário exclusivo e renomeia, para não deixar cassetes pela
+    # metade nem colidir com outra gravação simultânea da mesma chave
+    caminho = caminho_cassete(agent, chave)
+    with tempfile.NamedTemporaryFile(dir=CASSETTE_DIR, suffix=".tmp", delete=False) as temporario:
+        with gzip.open(temporario, "wt", encoding="utf-8") as arquivo:
+            json.dump(cassete, arquivo, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temporario.name, caminho)
+
+# Anota o início ("t") de uma revisão (um membro gzip por linha, então dá para ir acrescentando).
+# É chamada quando a revisão termina, para que só entrem chegadas com todos os cassetes gravados.
+# "modo" é o caminho da revisão: "texto" (orquestrador) ou "achados" (lote, saída estruturada),
+# para que a reprodução gere as mesmas chamadas gravadas nos cassetes
+def registrar_chegada(t, codigo, especialistas=None, modo="texto", arquivo=None):
+    tenant, classe = JOB_ATUAL.get()
+    chegada = {"t": t, "codigo": codigo, "especialistas": especialistas, "tenant": tenant, "classe": classe,
+               "modo": modo, "arquivo": arquivo}
+    with _chegadas_lock:
+        os.makedirs(CASSETTE_DIR, exist_ok=True)
+        with gzip.open(CHEGADAS_ARQUIVO, "at", encoding="utf-8") as arquivo:
+            arquivo.write(json.dumps(chegada, ensure_ascii=False) + "\n")
+
+def carregar_chegadas(caminho=CHEGADAS_ARQUIVO):
+    with gzip.open(caminho, "rt", encoding="utf-8") as arquivo:
+        chegadas = [json.loads(linha) for linha in arquivo if linha.strip()]
+    return sorted(chegadas, key=lambda chegada: chegada["t"])
+
+# Devolve os eventos gravados respeitando o tempo original (escalado por CASSETTE_VELOCIDADE)
+def reproduzir_cassete(agent: Agent, chave: str):
+    caminho = caminho_cassete(agent, chave)
+    if not os.path.exists(caminho):
+        raise FileNotFoundError(
+            f"Cassete não encontrado para o agente {agent.name}: {caminho}. "
+            "Grave-o antes com CASSETTE_MODE=record."
+        )
+    with gzip.open(caminho, "rt", encoding="utf-8") as arquivo:
+        cassete = json.load(arquivo)
+    inicio = time.monotonic()
+    for gravado in cassete["eventos"]:
+        if CASSETTE_VELOCIDADE > 0:
+            espera = gravado["t"] / CASSETTE_VELOCIDADE - (time.monotonic() - inicio)
+            if espera > 0:
+                time.sleep(espera)
+        yield Event.model_validate(gravado["evento"])
+####
+
+
 
 # --- Agente 1: ErrorDetector --- #
-def agente_errordetector(codigo):
+@rastreado("agente_errordetector")
+def agente_errordetector(codigo, estruturado=False):
     errordetector = Agent(
         name="errordetector",
         model="gemini-2.0-flash",
         tools=[google_search],
+        output_schema=RelatorioEstruturado if estruturado else None,
         instruction="""
         Você é o ErrorDetector, um especialista dedicado exclusivamente à identificação e correção de erros em código. Sua expertise está em detectar problemas que impedem o código de executar corretamente ou que causariam falhas em produção.
 
@@ -152,16 +570,20 @@ def agente_errordetector(codigo):
     )
 
     entrada_do_agente_errordetector = f"Certo, vamos analisar esse {codigo}..."
+    if estruturado:
+        entrada_do_agente_errordetector = entrada_estruturada(codigo)
     # Executa o agente
     erros_codigo = call_agent(errordetector, entrada_do_agente_errordetector)
     return erros_codigo
 
 # --- Agente 2: PerfOptimizer --- #
-def agente_perfoptimizer(codigo):
+@rastreado("agente_perfoptimizer")
+def agente_perfoptimizer(codigo, estruturado=False):
     perfoptimizer = Agent(
         name="perfoptimizer",
         model="gemini-2.0-flash",
         tools=[google_search],
+        output_schema=RelatorioEstruturado if estruturado else None,
         instruction="""
         Você é o PerfOptimizer, um especialista em otimização de código e análise de performance. Sua expertise está em identificar ineficiências computacionais e sugerir melhorias que tornem o código mais rápido, eficiente e escalável.
 
@@ -256,16 +678,20 @@ def agente_perfoptimizer(codigo):
     )
 
     entrada_do_agente_perfoptimizer = f"Certo, vamos analisar esse {codigo}..."
+    if estruturado:
+        entrada_do_agente_perfoptimizer = entrada_estruturada(codigo)
     # Executa o agente
     performance_codigo = call_agent(perfoptimizer, entrada_do_agente_perfoptimizer)
     return performance_codigo
 
 # --- Agente 3: CodeStylist --- #
-def agente_codestylist(codigo):
+@rastreado("agente_codestylist")
+def agente_codestylist(codigo, estruturado=False):
     codestylist = Agent(
         name="codestylist",
         model="gemini-2.0-flash",
         tools=[google_search],
+        output_schema=RelatorioEstruturado if estruturado else None,
         instruction="""
         Você é o CodeStylist, um especialista dedicado à análise de legibilidade, manutenibilidade e estilo de código. Sua expertise está em avaliar quão fácil será para outros desenvolvedores entenderem, modificarem e manterem o código, garantindo aderência às melhores práticas da indústria.
 
@@ -375,16 +801,20 @@ def agente_codestylist(codigo):
     )
 
     entrada_do_agente_codestylist = f"Certo, vamos analisar esse {codigo}..."
+    if estruturado:
+        entrada_do_agente_codestylist = entrada_estruturada(codigo)
     # Executa o agente
     estilo_codigo = call_agent(codestylist, entrada_do_agente_codestylist)
     return estilo_codigo
 
 # --- Agente 4: AccessibilityAuditor --- #
-def agente_accessibilityauditor(codigo):
+@rastreado("agente_accessibilityauditor")
+def agente_accessibilityauditor(codigo, estruturado=False):
     accessibilityauditor = Agent(
         name="accessibilityauditor",
         model="gemini-2.0-flash",
         tools=[google_search],
+        output_schema=RelatorioEstruturado if estruturado else None,
         instruction="""
         Você é o AccessibilityAuditor, um especialista dedicado à análise de acessibilidade em código front-end (HTML, CSS e JavaScript). Sua expertise está em identificar barreiras que possam impedir pessoas com deficiências de usar aplicações web efetivamente, garantindo conformidade com as diretrizes WCAG (Web Content Accessibility Guidelines).
 
@@ -506,16 +936,20 @@ def agente_accessibilityauditor(codigo):
     )
 
     entrada_do_agente_accessibilityauditor = f"Certo, vamos analisar esse {codigo}..."
+    if estruturado:
+        entrada_do_agente_accessibilityauditor = entrada_estruturada(codigo)
     # Executa o agente
     acessibilidade_codigo = call_agent(accessibilityauditor, entrada_do_agente_accessibilityauditor)
     return acessibilidade_codigo
 
 # --- Agente 5: SecurityScanner --- #
-def agente_securityscanner(codigo):
+@rastreado("agente_securityscanner")
+def agente_securityscanner(codigo, estruturado=False):
     securityscanner = Agent(
         name="securityscanner",
         model="gemini-2.0-flash",
         tools=[google_search],
+        output_schema=RelatorioEstruturado if estruturado else None,
         instruction="""
         Você é o SecurityScanner, um especialista dedicado à identificação de vulnerabilidades básicas de segurança em código. Sua expertise está em detectar padrões comuns que podem levar a falhas de segurança, mesmo sem acesso ao contexto completo da aplicação. Você não é um scanner de segurança completo, mas um identificador de "red flags" óbvias que poderiam comprometer a segurança do sistema.
 
@@ -631,12 +1065,16 @@ def agente_securityscanner(codigo):
     )
 
     entrada_do_agente_securityscanner = f"Certo, vamos analisar esse {codigo}..."
+    if estruturado:
+        entrada_do_agente_securityscanner = entrada_estruturada(codigo)
     # Executa o agente
     seguranca_codigo = call_agent(securityscanner, entrada_do_agente_securityscanner)
     return seguranca_codigo
 
 # --- Agente 6: CodeReviewer AI-Core --- #
-def agente_codereviewer(codigo):
+@rastreado("agente_codereviewer")
+def agente_codereviewer(codigo, especialistas=None):
+    chegada = time.time()
     codereviewer = Agent(
         name="codereviewer",
         model="gemini-2.0-flash",
@@ -769,19 +1207,908 @@ def agente_codereviewer(codigo):
 
     entrada_do_agente_codereviewer = f"Certo, vamos analisar esse {codigo}..."
     # Puxa o resultado dos outros agentes
-    resultados_codereviewer = [
-        agente_errordetector(codigo),
-        agente_codestylist(codigo),
-        agente_securityscanner(codigo),
-        agente_accessibilityauditor(codigo),
-        agente_perfoptimizer(codigo)      
-    ]
-    # Executa o agente
-    revisao_codigo = call_agent(codereviewer, resultados_codereviewer, entrada_do_agente_codereviewer)
+    resultados_codereviewer = list(revisar_especialistas(codigo, especialistas).values())
+    # Executa o agente com o código e os relatórios dos especialistas
+    entrada_do_agente_codereviewer += "\n\n" + "\n\n".join(resultados_codereviewer)
+    revisao_codigo = call_agent(codereviewer, entrada_do_agente_codereviewer)
+    if CASSETTE_MODE == "record":
+        registrar_chegada(chegada, codigo, especialistas)
     return revisao_codigo
 
+# --- Especialistas --- #
+ESPECIALISTAS = {
+    "errordetector": agente_errordetector,
+    "codestylist": agente_codestylist,
+    "securityscanner": agente_securityscanner,
+    "accessibilityauditor": agente_accessibilityauditor,
+    "perfoptimizer": agente_perfoptimizer,
+}
+
+# Executa os especialistas (independentes entre si, então rodam em paralelo).
+# "especialistas" é uma lista de nomes; por padrão todos são executados.
+# Com estruturado=True devolve um RelatorioEstruturado por especialista.
+def revisar_especialistas(codigo, especialistas=None, estruturado=False):
+    nomes = list(especialistas or ESPECIALISTAS)
+    # Cada thread recebe uma cópia do contexto, para manter o tenant/classe do job atual
+    contextos = [contextvars.copy_context() for _ in nomes]
+    with ThreadPoolExecutor(max_workers=len(nomes)) as executor:
+        relatorios = executor.map(lambda nome, contexto: contexto.run(ESPECIALISTAS[nome], codigo, estruturado), nomes, contextos)
+        relatorios = dict(zip(nomes, relatorios))
+    if estruturado:
+        return {nome: RelatorioEstruturado.model_validate_json(texto) for nome, texto in relatorios.items()}
+    return relatorios
+
+# --- Orçamento de tokens: estimativa e planejamento antes de enviar aos agentes --- #
+ORCAMENTO_TOKENS_REVISAO = int(os.getenv("ORCAMENTO_TOKENS_REVISAO", "200000"))
+ORCAMENTO_TOKENS_LOTE = int(os.getenv("ORCAMENTO_TOKENS_LOTE", "0"))  # 0 = sem limite
+LIMITE_CONTEXTO_TOKENS = int(os.getenv("LIMITE_CONTEXTO_TOKENS", "1000000"))
+PRECO_ENTRADA_POR_MILHAO = float(os.getenv("PRECO_ENTRADA_POR_MILHAO", "0.10"))
+PRECO_SAIDA_POR_MILHAO = float(os.getenv("PRECO_SAIDA_POR_MILHAO", "0.40"))
+
+# Tokens das instruções de cada agente (medidos com estimar_tokens sobre os prompts atuais)
+TOKENS_INSTRUCAO = {
+    "errordetector": 740,
+    "perfoptimizer": 990,
+    "codestylist": 1150,
+    "accessibilityauditor": 1280,
+    "securityscanner": 1300,
+    "codereviewer": 1280,
+}
+# Tamanho típico das respostas
+TOKENS_SAIDA_ESPECIALISTA = 1500
+TOKENS_SAIDA_CODEREVIEWER = 3000
+# Ordem em que os especialistas são dispensados quando a revisão não cabe no orçamento
+ESPECIALISTAS_DISPENSAVEIS = ["accessibilityauditor", "codestylist", "perfoptimizer"]
+# O que fazer com conteúdo que não vale a pena enviar inteiro aos agentes
+ACAO_POR_CONTEUDO = {"binario": "pular", "gerado": "pular", "minificado": "resumir", "log": "resumir"}
+TOKENS_RESUMO = 4000
+
+REGEX_TOKEN = re.compile(r"\w+|[^\w\s]")
+# Avisos usuais de arquivo gerado (@generated, "Code generated by ... DO NOT EDIT", <auto-generated>)
+REGEX_GERADO = re.compile(r"@generated\b|\b(?:code )?generated by\b.*\bdo not edit\b|<auto-generated\b", re.IGNORECASE)
+PREFIXOS_COMENTARIO = ("#", "//", "/*", "*", "<!--", "--", ";")
+REGEX_LINHA_LOG = re.compile(r"^\s*\[?(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}|DEBUG|INFO|WARN|WARNING|ERROR|TRACE|FATAL)\b")
+
+# Estimativa local e rápida: cada palavra/símbolo vale um token, palavras longas valem mais.
+# Textos grandes são estimados por amostragem do início e do fim.
+def estimar_tokens(texto):
+    if len(texto) > 200_000:
+        amostra = texto[:100_000] + texto[-100_000:]
+        return int(estimar_tokens(amostra) * len(texto) / len(amostra))
+    return sum(1 + len(pedaco) // 6 for pedaco in REGEX_TOKEN.findall(texto))
+
+# Linhas de comentário do início do arquivo (antes do primeiro código), onde ficam os
+# avisos de arquivo gerado; menções no meio do código ou em docstrings não contam
+def comentarios_do_cabecalho(codigo, maximo=30):
+    cabecalho = []
+    for linha in codigo[:8192].splitlines():
+        linha = linha.strip()
+        if not linha:
+            continue
+        if not linha.startswith(PREFIXOS_COMENTARIO) or len(cabecalho) >= maximo:
+            break
+        cabecalho.append(linha)
+    return cabecalho
+
+# Detecta conteúdo binário, gerado, minificado ou de log (None = código comum)
+def classificar_conteudo(codigo):
+    amostra = codigo[:8192]
+    controle = sum(1 for caractere in amostra if (caractere < " " and caractere not in "\t\n\r") or caractere == "\ufffd")
+    if controle > len(amostra) * 0.05:
+        return "binario"
+    if any(REGEX_GERADO.search(linha) for linha in comentarios_do_cabecalho(codigo)):
+        return "gerado"
+    linhas = codigo.splitlines() or [""]
+    if max(map(len, linhas)) > 1000 and len(codigo) / len(linhas) > 200:
+        return "minificado"
+    inicio = linhas[:200]
+    if len(linhas) >= 20 and sum(1 for linha in inicio if REGEX_LINHA_LOG.match(linha)) > len(inicio) / 2:
+        return "log"
+    return None
+
+# Mantém o início e o fim do conteúdo dentro de "limite_tokens", medidos com
+# estimar_tokens (a mesma regra usada pelo planejamento)
+def resumir_conteudo(codigo, limite_tokens):
+    total = estimar_tokens(codigo)
+    if total <= limite_tokens:
+        return codigo
+    # Parte da densidade média de tokens do conteúdo e encolhe até caber
+    metade = int(len(codigo) * limite_tokens / total / 2)
+    while metade > 0 and estimar_tokens(codigo[:metade]) + estimar_tokens(codigo[-metade:]) > limite_tokens:
+        metade = int(metade * 0.9)
+    inicio, fim = (codigo[:metade], codigo[-metade:]) if metade > 0 else ("", "")
+    omitidos = len(codigo) - len(inicio) - len(fim)
+    return f"{inicio}\n\n[... {omitidos} caracteres omitidos: conteúdo resumido antes do envio ...]\n\n{fim}"
+
+# Divide o código em partes de até "limite_tokens", sem quebrar linhas.
+# Devolve (linha inicial, texto) de cada parte.
+def dividir_em_partes(codigo, limite_tokens):
+    partes = []
+    atual, tokens, inicio = [], 0, 1
+    for numero, linha in enumerate(codigo.splitlines(keepends=True), 1):
+        tokens_linha = estimar_tokens(linha)
+        if atual and tokens + tokens_linha > limite_tokens:
+            partes.append((inicio, "".join(atual)))
+            atual, tokens, inicio = [], 0, numero
+        atual.append(linha)
+        tokens += tokens_linha
+    if atual:
+        partes.append((inicio, "".join(atual)))
+    return partes
+
+# Tokens de entrada e saída de todo o pipeline para uma parte do código
+def estimar_pipeline(tokens_codigo, especialistas, orquestrador=True):
+    saida = TOKENS_SAIDA_ESPECIALISTA * len(especialistas)
+    entrada = sum(TOKENS_INSTRUCAO[nome] + tokens_codigo for nome in especialistas)
+    if orquestrador:
+        # O orquestrador recebe o código e os relatórios dos especialistas
+        entrada += TOKENS_INSTRUCAO["codereviewer"] + tokens_codigo + saida
+        saida += TOKENS_SAIDA_CODEREVIEWER
+    return entrada, saida
+
+# Decide, antes de qualquer chamada ao modelo, como o código será revisado:
+# resumido ou pulado conforme o conteúdo, dividido em partes se não couber no
+# contexto e com menos especialistas se passar do orçamento (0 = sem limite).
+# "especialistas" restringe os agentes de partida; o orçamento ainda pode dispensar alguns deles
+def planejar_revisao(codigo, orcamento=ORCAMENTO_TOKENS_REVISAO, orquestrador=True, especialistas=None):
+    solicitados = list(especialistas or ESPECIALISTAS)
+    plano = {
+        "acao": "revisar", "conteudo": classificar_conteudo(codigo), "ajustes": [],
+        "especialistas": list(solicitados), "partes": [], "tokens_entrada": 0, "tokens_saida": 0,
+        "custo": 0.0, "motivo": "", "resumido": False,
+    }
+    acao = ACAO_POR_CONTEUDO.get(plano["conteudo"])
+    if acao == "pular":
+        plano.update(acao="pular", motivo=f"conteúdo {plano['conteudo']}")
+        return plano
+    if acao == "resumir":
+        resumo = resumir_conteudo(codigo, TOKENS_RESUMO)
+        if resumo != codigo:
+            codigo = resumo
+            plano["resumido"] = True
+            plano["ajustes"].append(f"resumido ({plano['conteudo']})")
+
+    # Cada parte precisa caber no contexto do orquestrador, que recebe o código e os relatórios
+    limite_parte = LIMITE_CONTEXTO_TOKENS - TOKENS_INSTRUCAO["codereviewer"] - TOKENS_SAIDA_ESPECIALISTA * len(ESPECIALISTAS)
+    tokens_codigo = estimar_tokens(codigo)
+    if tokens_codigo > limite_parte:
+        plano["partes"] = dividir_em_partes(codigo, limite_parte)
+        tokens_partes = [estimar_tokens(texto) for _, texto in plano["partes"]]
+        plano["ajustes"].append(f"em {len(plano['partes'])} partes")
+    else:
+        plano["partes"] = [(1, codigo)]
+        tokens_partes = [tokens_codigo]
+
+    dispensaveis = [nome for nome in ESPECIALISTAS_DISPENSAVEIS if nome in solicitados]
+    while True:
+        estimativas = [estimar_pipeline(tokens, plano["especialistas"], orquestrador) for tokens in tokens_partes]
+        entrada = sum(estimativa[0] for estimativa in estimativas)
+        saida = sum(estimativa[1] for estimativa in estimativas)
+        if orcamento <= 0 or entrada + saida <= orcamento or not dispensaveis:
+            break
+        plano["especialistas"].remove(dispensaveis.pop(0))
+    if len(plano["especialistas"]) < len(solicitados):
+        plano["ajustes"].append(f"agentes reduzidos ({', '.join(plano['especialistas'])})")
+    plano.update(
+        tokens_entrada=entrada, tokens_saida=saida,
+        custo=entrada / 1e6 * PRECO_ENTRADA_POR_MILHAO + saida / 1e6 * PRECO_SAIDA_POR_MILHAO,
+    )
+    if 0 < orcamento < entrada + saida:
+        plano.update(acao="pular", motivo=f"estimativa de {entrada + saida} tokens acima do orçamento de {orcamento}")
+    return plano
+
+def descrever_plano(plano):
+    if plano["acao"] == "pular":
+        return f"⏭️ Revisão ignorada: {plano['motivo']}"
+    ajustes = f" | {'; '.join(plano['ajustes'])}" if plano["ajustes"] else ""
+    return (f"📊 Estimativa: {plano['tokens_entrada']} tokens de entrada, {plano['tokens_saida']} de saída, "
+            f"~US$ {plano['custo']:.4f}{ajustes}")
+
+# Executa o plano e junta as revisões das partes
+def revisar_com_plano(plano):
+    if plano["acao"] == "pular":
+        return descrever_plano(plano)
+    revisoes = [agente_codereviewer(texto, plano["especialistas"]) for _, texto in plano["partes"]]
+    if len(revisoes) == 1:
+        return revisoes[0]
+    return "\n\n".join(
+        f"## Parte {indice}/{len(revisoes)} (a partir da linha {linha})\n\n{revisao}"
+        for indice, ((linha, _), revisao) in enumerate(zip(plano["partes"], revisoes), 1)
+    )
+
+def revisar_codigo(codigo):
+    if SERVIDOR_URL:
+        return revisar_no_servidor(codigo)["resposta"]
+    return revisar_com_plano(planejar_revisao(codigo))
+
+# Orçamento compartilhado por todas as revisões de um lote (limite 0 = sem limite)
+class OrcamentoTokens:
+    def __init__(self, limite):
+        self.limite = limite
+        self.usado = 0
+        self.lock = threading.Lock()
+
+    def restante(self):
+        return self.limite - self.usado if self.limite > 0 else 0
+
+    def reservar(self, tokens):
+        if self.limite <= 0:
+            return True
+        with self.lock:
+            if self.usado + tokens > self.limite:
+                return False
+            self.usado += tokens
+            return True
+
+# --- Gerador de carga --- #
+# Percentil simples (p entre 0 e 100) sobre uma lista de valores
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+# Executa várias revisões em paralelo e mede vazão e latência.
+# Combinado com CASSETTE_MODE=replay reproduz a carga gravada sem acessar o Gemini.
+# "modo" escolhe o caminho revisado: "texto" (orquestrador) ou "achados" (o do lote)
+def gerar_carga(codigos, concorrencia=4, classe="lote", modo="texto"):
+    latencias = []
+
+    def revisar(codigo):
+        inicio = time.monotonic()
+        with job(TENANT, classe), span("revisão", cat="carga", tamanho=len(codigo)):
+            revisar_para_carga(codigo, modo=modo)
+        latencias.append(time.monotonic() - inicio)
+
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        list(executor.map(revisar, codigos))
+    exibir_resumo_carga(latencias, time.monotonic() - inicio, f"concorrência {concorrencia}")
+    return latencias
+
+# Carga em malha aberta: cada revisão começa no instante em que chegou na gravação
+# (escalado por CASSETTE_VELOCIDADE), sem esperar as anteriores terminarem.
+# A latência conta a partir da chegada prevista, incluindo o tempo em fila.
+# Cada chegada mantém o tenant e a classe gravados, a não ser que "classe" seja informada.
+def gerar_carga_aberta(chegadas, classe=None):
+    latencias = []
+    threads = []
+
+    def revisar(chegada, agendado):
+        job_chegada = job(chegada.get("tenant", TENANT), classe or chegada.get("classe", "lote"))
+        with job_chegada, span("revisão", cat="carga", tamanho=len(chegada["codigo"])):
+            revisar_para_carga(chegada["codigo"], chegada.get("especialistas"), chegada.get("modo", "texto"), chegada.get("arquivo"))
+        latencias.append(time.monotonic() - agendado)
+
+    inicio = time.monotonic()
+    primeira = chegadas[0]["t"] if chegadas else 0
+    for chegada in chegadas:
+        deslocamento = (chegada["t"] - primeira) / CASSETTE_VELOCIDADE if CASSETTE_VELOCIDADE > 0 else 0
+        agendado = inicio + deslocamento
+        espera = agendado - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(revisar, chegada, agendado))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    exibir_resumo_carga(latencias, time.monotonic() - inicio, f"malha aberta, velocidade {CASSETTE_VELOCIDADE}x")
+    return latencias
+
+# Revisa pelo mesmo caminho da gravação ("texto" ou "achados"); com SERVIDOR_URL a carga
+# passa pelo servidor, junto com os demais clientes
+def revisar_para_carga(codigo, especialistas=None, modo="texto", arquivo=None):
+    if modo == "achados":
+        if SERVIDOR_URL:
+            return revisar_no_servidor(codigo, "achados", especialistas=especialistas, arquivo=arquivo)["achados"]
+        return revisar_achados(arquivo or "codigo", codigo, OrcamentoTokens(0), especialistas)
+    if SERVIDOR_URL:
+        return revisar_no_servidor(codigo, especialistas=especialistas)["resposta"]
+    return agente_codereviewer(codigo, especialistas)
+
+def exibir_resumo_carga(latencias, duracao, descricao):
+    print(f"Revisões: {len(latencias)} em {duracao:.1f}s ({descricao})")
+    print(f"Vazão: {len(latencias) / max(duracao, 1e-9) * 60:.1f} revisões/min")
+    print(f"Latência p50: {percentil(latencias, 50):.2f}s | p95: {percentil(latencias, 95):.2f}s | máx: {max(latencias, default=0):.2f}s")
+    print(relatorio_agendador())
+
+# --- Modo watch: revisão incremental ao salvar arquivos --- #
+WATCH_EXTENSOES = {".py", ".js", ".jsx", ".ts", ".tsx", ".html", ".css", ".java", ".go", ".rb", ".cs", ".php", ".c", ".cpp", ".h"}
+WATCH_IGNORADOS = {".git", "__pycache__", "node_modules", "venv", ".venv", "cassetes"}
+
+# Constantes do inotify (linux/inotify.h)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+
+def arquivo_observado(caminho):
+    return os.path.splitext(caminho)[1].lower() in WATCH_EXTENSOES
+
+def listar_arquivos(diretorio):
+    for raiz, subdirs, arquivos in os.walk(diretorio):
+        subdirs[:] = [nome for nome in subdirs if nome not in WATCH_IGNORADOS]
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            if arquivo_observado(caminho):
+                yield caminho
+
+# Backend inotify (Linux). Devolve esperar(timeout) -> caminhos alterados, ou None se indisponível
+def esperar_inotify(diretorio):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mascara = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    diretorios = {}
+
+    def observar(caminho):
+        wd = libc.inotify_add_watch(fd, os.fsencode(caminho), mascara)
+        if wd >= 0:
+            diretorios[wd] = caminho
+
+    for raiz, subdirs, _ in os.walk(diretorio):
+        subdirs[:] = [nome for nome in subdirs if nome not in WATCH_IGNORADOS]
+        observar(raiz)
+    cabecalho = struct.Struct("iIII")
+
+    def esperar(timeout):
+        prontos, _, _ = select.select([fd], [], [], timeout)
+        if not prontos:
+            return set()
+        dados = os.read(fd, 64 * 1024)
+        alterados = set()
+        posicao = 0
+        while posicao < len(dados):
+            wd, mask, _, tamanho = cabecalho.unpack_from(dados, posicao)
+            nome = dados[posicao + cabecalho.size:posicao + cabecalho.size + tamanho].rstrip(b"\0")
+            posicao += cabecalho.size + tamanho
+            if wd not in diretorios or not nome:
+                continue
+            caminho = os.path.join(diretorios[wd], os.fsdecode(nome))
+            if mask & IN_ISDIR:
+                # Passa a observar também as pastas novas
+                if mask & (IN_CREATE | IN_MOVED_TO) and os.path.basename(caminho) not in WATCH_IGNORADOS:
+                    observar(caminho)
+                continue
+            alterados.add(caminho)
+        return alterados
+
+    return esperar
+
+# Backend por polling: compara as datas de modificação a cada "intervalo" segundos
+def esperar_polling(diretorio, intervalo=1.0):
+    def instantaneo():
+        estado = {}
+        for caminho in listar_arquivos(diretorio):
+            try:
+                estado[caminho] = os.stat(caminho).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return estado
+
+    estado = instantaneo()
+
+    def esperar(timeout):
+        nonlocal estado
+        limite = None if timeout is None else time.monotonic() + timeout
+        while True:
+            atual = instantaneo()
+            alterados = {caminho for caminho in atual.keys() | estado.keys() if atual.get(caminho) != estado.get(caminho)}
+            estado = atual
+            if alterados:
+                return alterados
+            if limite is None:
+                time.sleep(intervalo)
+            elif time.monotonic() >= limite:
+                return set()
+            else:
+                time.sleep(min(intervalo, limite - time.monotonic()))
+
+    return esperar
+
+# Produz conjuntos de arquivos alterados, agrupando rajadas de salvamentos (debounce)
+def observar_alteracoes(diretorio, debounce=0.5):
+    esperar = esperar_inotify(diretorio)
+    if esperar is None:
+        print("inotify indisponível, usando polling.")
+        esperar = esperar_polling(diretorio)
+    while True:
+        alterados = esperar(None)
+        # Continua acumulando enquanto chegarem alterações dentro do intervalo de debounce
+        while True:
+            mais = esperar(debounce)
+            if not mais:
+                break
+            alterados |= mais
+        yield alterados
+
+# Separa o arquivo em unidades revisáveis: funções, métodos e o restante do módulo.
+# Arquivos que não são Python (ou não compilam) viram uma única unidade.
+# Nomes repetidos (ex: getter e setter de uma property, função redefinida) recebem
+# um sufixo pela ordem em que aparecem: "C.x", "C.x#2".
+def extrair_unidades(caminho, conteudo):
+    if not caminho.endswith(".py"):
+        return {"<arquivo>": conteudo} if conteudo.strip() else {}
+    try:
+        arvore = ast.parse(conteudo)
+    except SyntaxError:
+        return {"<arquivo>": conteudo}
+    linhas = conteudo.splitlines(keepends=True)
+    unidades = {}
+    usadas = set()
+    for no in arvore.body:
+        if isinstance(no, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            filhos = [(no.name, no)]
+        elif isinstance(no, ast.ClassDef):
+            filhos = [(f"{no.name}.{filho.name}", filho) for filho in no.body
+                      if isinstance(filho, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        else:
+            continue
+        for nome, filho in filhos:
+            inicio = min([filho.lineno] + [decorador.lineno for decorador in filho.decorator_list])
+            ocorrencia = 2
+            chave = nome
+            while chave in unidades:
+                chave = f"{nome}#{ocorrencia}"
+                ocorrencia += 1
+            unidades[chave] = "".join(linhas[inicio - 1:filho.end_lineno])
+            usadas.update(range(inicio, filho.end_lineno + 1))
+    restante = "".join(linha for numero, linha in enumerate(linhas, 1) if numero not in usadas)
+    if restante.strip():
+        unidades["<módulo>"] = restante
+    return unidades
+
+def hash_unidade(fonte):
+    return hashlib.sha256(fonte.encode("utf-8")).hexdigest()
+
+# Lê as unidades do arquivo; devolve None se ele sumiu ou não pôde ser lido
+def ler_unidades(caminho):
+    try:
+        with open(caminho, encoding="utf-8", errors="replace") as arquivo:
+            return extrair_unidades(caminho, arquivo.read())
+    except OSError as erro:
+        print(f"⚠️ Não foi possível ler {caminho}: {erro}")
+        return None
+
+# Revisa apenas as unidades que mudaram desde a última revisão; o resto vem do cache.
+# Uma unidade cuja revisão falhou fica fora do cache e é revisada de novo na próxima alteração.
+def revisar_alteracoes(alterados, indice, cache, concorrencia=4):
+    inicio = time.monotonic()
+    alteradas = []
+    pendentes = {}
+    for caminho in sorted(alterados):
+        if not arquivo_observado(caminho):
+            continue
+        unidades = ler_unidades(caminho) if os.path.isfile(caminho) else None
+        if unidades is None:
+            indice.pop(caminho, None)
+            continue
+        anteriores = indice.get(caminho, {})
+        indice[caminho] = {}
+        for nome, fonte in unidades.items():
+            chave = hash_unidade(fonte)
+            indice[caminho][nome] = chave
+            if anteriores.get(nome) != chave:
+                alteradas.append((caminho, nome, chave))
+                if chave not in cache:
+                    pendentes[chave] = fonte
+    if not alteradas:
+        return
+    erros = {}
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        futuros = {chave: executor.submit(contextvars.copy_context().run, revisar_codigo, fonte)
+                   for chave, fonte in pendentes.items()}
+        for chave, futuro in futuros.items():
+            try:
+                cache[chave] = futuro.result()
+            except Exception as erro:
+                erros[chave] = f"{type(erro).__name__}: {erro}"
+    # Marca as unidades que falharam para que sejam revisadas de novo
+    for caminho, nome, chave in alteradas:
+        if chave in erros:
+            indice[caminho][nome] = None
+    exibir_relatorio_watch(alteradas, indice, cache, erros, len(pendentes) - len(erros), time.monotonic() - inicio)
+
+def exibir_relatorio_watch(alteradas, indice, cache, erros, revisadas, duracao):
+    # Limpa o terminal antes de mostrar o relatório atualizado
+    print("\033[2J\033[H", end="")
+    print(f"🔁 Relatório atualizado às {time.strftime('%H:%M:%S')} ({duracao:.1f}s)")
+    print(f"Unidades alteradas: {len(alteradas)} | revisadas agora: {revisadas} | com erro: {len(erros)} "
+          f"| reaproveitadas do cache: {len(alteradas) - revisadas - len(erros)}")
+    for caminho, nome, chave in alteradas:
+        print(f"\n=== {caminho} :: {nome} ===\n")
+        if chave in erros:
+            print(f"❌ Erro ao revisar (será tentado de novo na próxima alteração): {erros[chave]}")
+        else:
+            print(cache[chave])
+    # O terminal foi limpo: as revisões ainda válidas das demais unidades vêm do cache,
+    # primeiro as dos arquivos alterados agora
+    exibidas = set(alteradas)
+    arquivos_alterados = {caminho for caminho, _, _ in alteradas}
+    anteriores = sorted(
+        ((caminho, nome, chave) for caminho, unidades in indice.items() for nome, chave in unidades.items()
+         if chave in cache and (caminho, nome, chave) not in exibidas),
+        key=lambda unidade: (unidade[0] not in arquivos_alterados, unidade[0]),
+    )
+    if anteriores:
+        print(f"\n--- Revisões anteriores ainda válidas ({len(anteriores)}) ---")
+        for caminho, nome, chave in anteriores:
+            print(f"\n=== {caminho} :: {nome} (sem alterações) ===\n")
+            print(cache[chave])
+    print(f"\n{relatorio_agendador()}")
+
+def modo_watch(diretorio, debounce=0.5, concorrencia=4):
+    indice = {}
+    cache = {}
+    # Indexa o estado atual; só o que mudar a partir daqui é revisado
+    for caminho in listar_arquivos(diretorio):
+        unidades = ler_unidades(caminho)
+        if unidades is not None:
+            indice[caminho] = {nome: hash_unidade(fonte) for nome, fonte in unidades.items()}
+    print(f"👀 Observando {diretorio} ({sum(len(u) for u in indice.values())} unidades indexadas). Ctrl+C para sair.")
+    try:
+        for alterados in observar_alteracoes(diretorio, debounce):
+            # Um erro inesperado numa rodada não pode encerrar o watch
+            try:
+                revisar_alteracoes(alterados, indice, cache, concorrencia)
+            except Exception as erro:
+                print(f"❌ Erro ao processar alterações ({type(erro).__name__}: {erro}); continuando a observar.")
+    except KeyboardInterrupt:
+        print("\nModo watch encerrado.")
+
+# --- Revisão em lote com relatórios em fluxo (JSON Lines, SARIF, HTML) --- #
+# Cada achado é um dicionário com um problema: arquivo, agente, regra, severidade
+# (Alta/Média/Baixa ou None), linha (ou None) e mensagem. Os escritores gravam cada
+# achado assim que ele chega, então a memória não cresce com o número de arquivos.
+NIVEL_SARIF = {"Alta": "error", "Média": "warning", "Baixa": "note"}
+
+# Um achado por problema do relatório estruturado; "linha_inicial" desloca as linhas
+# quando o código foi revisado em partes. Linhas fora do trecho revisado ("total_linhas")
+# são descartadas, e com linha_inicial=None (conteúdo resumido) nenhuma linha corresponde
+# ao arquivo. Assim o SARIF nunca recebe um startLine inválido.
+def criar_achados(caminho, agente, relatorio: RelatorioEstruturado, linha_inicial=1, total_linhas=None):
+    def linha_no_arquivo(linha):
+        if linha_inicial is None or not linha or linha < 1 or (total_linhas and linha > total_linhas):
+            return None
+        return linha + linha_inicial - 1
+
+    return [{
+        "arquivo": caminho,
+        "agente": agente,
+        "regra": f"{agente}/{problema.regra}",
+        "severidade": problema.severidade,
+        "linha": linha_no_arquivo(problema.linha),
+        "mensagem": problema.mensagem,
+    } for problema in relatorio.problemas]
+
+# Achado sem problema de código: arquivo ignorado pelo planejamento ou revisão que falhou
+def achado_informativo(caminho, agente, regra, mensagem):
+    return {"arquivo": caminho, "agente": agente, "regra": regra, "severidade": None, "linha": None, "mensagem": mensagem}
+
+# Revisa um arquivo com os especialistas e devolve os achados; "orcamento" é o
+# OrcamentoTokens compartilhado pelo lote
+def revisar_achados(caminho, codigo, orcamento, especialistas=None):
+    # O orçamento da revisão nunca passa do que ainda resta no lote
+    limite = ORCAMENTO_TOKENS_REVISAO
+    if orcamento.limite > 0:
+        limite = min(limite, orcamento.restante()) if limite > 0 else orcamento.restante()
+    # No lote só os especialistas rodam; o orquestrador não entra na conta
+    plano = planejar_revisao(codigo, limite, orquestrador=False, especialistas=especialistas)
+    if orcamento.limite > 0 and limite <= 0:
+        plano.update(acao="pular", motivo="orçamento do lote esgotado")
+    elif plano["acao"] != "pular" and not orcamento.reservar(plano["tokens_entrada"] + plano["tokens_saida"]):
+        plano.update(acao="pular", motivo="orçamento do lote esgotado")
+    if plano["acao"] == "pular":
+        return [achado_informativo(caminho, "planejador", "revisao-ignorada", descrever_plano(plano))]
+    chegada = time.time()
+    achados = []
+    for linha_inicial, texto in plano["partes"]:
+        relatorios = revisar_especialistas(texto, plano["especialistas"], estruturado=True)
+        for agente, relatorio in relatorios.items():
+            achados.extend(criar_achados(caminho, agente, relatorio, None if plano["resumido"] else linha_inicial,
+                                         len(texto.splitlines())))
+    if CASSETTE_MODE == "record":
+        registrar_chegada(chegada, codigo, plano["especialistas"], modo="achados", arquivo=caminho)
+    return achados
+
+class EscritorJSONL:
+    def __init__(self, caminho):
+        self.arquivo = open(caminho, "w", encoding="utf-8")
+
+    def escrever(self, achado):
+        self.arquivo.write(json.dumps(achado, ensure_ascii=False) + "\n")
+
+    def fechar(self):
+        self.arquivo.close()
+
+# SARIF 2.1.0: os resultados são gravados antes do bloco "tool", que só é
+# fechado no final (a ordem das chaves não importa para os leitores de SARIF)
+class EscritorSARIF:
+    def __init__(self, caminho):
+        self.arquivo = open(caminho, "w", encoding="utf-8")
+        self.regras = set()
+        self.primeiro = True
+        self.arquivo.write('{"$schema":"https://json.schemastore.org/sarif-2.1.0.json","version":"2.1.0","runs":[{"results":[')
+
+    def escrever(self, achado):
+        self.regras.add(achado["regra"])
+        regiao = {"region": {"startLine": achado["linha"]}} if achado["linha"] else {}
+        resultado = {
+            "ruleId": achado["regra"],
+            "level": NIVEL_SARIF.get(achado["severidade"], "note"),
+            "message": {"text": achado["mensagem"]},
+            "locations": [{"physicalLocation": {
+                "artifactLocation": {"uri": achado["arquivo"].replace(os.sep, "/")}, **regiao
+            }}],
+        }
+        self.arquivo.write(("" if self.primeiro else ",") + json.dumps(resultado, ensure_ascii=False))
+        self.primeiro = False
+
+    def fechar(self):
+        ferramenta = {"driver": {
+            "name": "CodeReviewerAI-Core",
+            "informationUri": "https://github.com/bagretest/code-reviewer_AI-Core",
+            "rules": [{"id": regra, "name": regra} for regra in sorted(self.regras)],
+        }}
+        self.arquivo.write('],"tool":' + json.dumps(ferramenta) + "}]}")
+        self.arquivo.close()
+
+# HTML autocontido (CSS embutido), um bloco recolhível por achado
+class EscritorHTML:
+    def __init__(self, caminho):
+        self.arquivo = open(caminho, "w", encoding="utf-8")
+        self.contagem = {}
+        self.arquivo.write("""<!DOCTYPE html>
+<html lang="pt-BR"><head><meta charset="utf-8"><title>Relatório de Revisão de Código</title>
+<style>
+body{font-family:system-ui,sans-serif;margin:2rem;color:#222}
+details{border:1px solid #ddd;border-radius:6px;margin:.4rem 0;padding:.4rem .8rem}
+summary{cursor:pointer}
+pre{white-space:pre-wrap;background:#f7f7f7;padding:.8rem;border-radius:4px}
+.sev{display:inline-block;min-width:4rem;text-align:center;border-radius:4px;padding:0 .4rem;margin-right:.5rem;color:#fff;background:#777}
+.Alta{background:#c62828}.Média{background:#ef6c00}.Baixa{background:#2e7d32}
+</style></head><body>
+<h1>Relatório de Revisão de Código</h1>
+""")
+
+    def escrever(self, achado):
+        severidade = achado["severidade"] or "—"
+        self.contagem[severidade] = self.contagem.get(severidade, 0) + 1
+        linha = f":{achado['linha']}" if achado["linha"] else ""
+        self.arquivo.write(
+            f'<details><summary><span class="sev {html.escape(severidade)}">{html.escape(severidade)}</span>'
+            f'{html.escape(achado["arquivo"])}{linha} — {html.escape(achado["regra"])}</summary>'
+            f'<pre>{html.escape(achado["mensagem"])}</pre></details>\n'
+        )
+
+    def fechar(self):
+        resumo = ", ".join(f"{severidade}: {total}" for severidade, total in sorted(self.contagem.items()))
+        self.arquivo.write(f"<p><strong>Total de achados:</strong> {sum(self.contagem.values())} ({html.escape(resumo)})</p>\n</body></html>\n")
+        self.arquivo.close()
+
+ESCRITORES = {"jsonl": EscritorJSONL, "sarif": EscritorSARIF, "html": EscritorHTML}
+
+# Revisa os arquivos com no máximo "concorrencia" revisões em andamento e grava
+# os achados de cada arquivo assim que ele termina
+def revisar_lote(arquivos, saida, formatos=("jsonl", "sarif", "html"), concorrencia=4, orcamento_lote=ORCAMENTO_TOKENS_LOTE):
+    escritores = [ESCRITORES[formato](f"{saida}.{formato}") for formato in formatos]
+    orcamento = OrcamentoTokens(orcamento_lote)
+    # Com SERVIDOR_URL o orçamento fica no servidor, separado por lote
+    id_lote = uuid.uuid4().hex
+    # Os relatórios (deste lote ou de um anterior com a mesma saída) podem estar dentro
+    # da pasta revisada e não devem ser revisados
+    relatorios = {os.path.abspath(f"{saida}.{formato}") for formato in ESCRITORES}
+    arquivos = (caminho for caminho in arquivos if os.path.abspath(caminho) not in relatorios)
+
+    # Uma falha (ex: erro transitório da API) vira um achado e não interrompe o lote
+    def revisar(caminho):
+        with job(TENANT, "lote"):
+            try:
+                return revisar_arquivo(caminho)
+            except Exception as erro:
+                return [achado_informativo(caminho, "lote", "erro-de-revisao",
+                                           f"Falha ao revisar o arquivo: {type(erro).__name__}: {erro}")]
+
+    def revisar_arquivo(caminho):
+        with open(caminho, encoding="utf-8", errors="replace") as arquivo:
+            codigo = arquivo.read()
+        if SERVIDOR_URL:
+            return revisar_no_servidor(codigo, "achados", arquivo=caminho, lote=id_lote,
+                                       orcamento_lote=orcamento_lote)["achados"]
+        return revisar_achados(caminho, codigo, orcamento)
+
+    falhas = 0
+
+    def gravar(achados):
+        nonlocal falhas
+        for achado in achados:
+            falhas += achado["regra"] == "erro-de-revisao"
+            for escritor in escritores:
+                escritor.escrever(achado)
+
+    total = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+            em_andamento = deque()
+            for caminho in arquivos:
+                em_andamento.append(executor.submit(revisar, caminho))
+                if len(em_andamento) >= concorrencia * 2:
+                    gravar(em_andamento.popleft().result())
+                    total += 1
+            while em_andamento:
+                gravar(em_andamento.popleft().result())
+                total += 1
+    finally:
+        for escritor in escritores:
+            escritor.fechar()
+    print(f"Lote concluído: {total} arquivos ({falhas} com erro). Relatórios: {', '.join(f'{saida}.{formato}' for formato in formatos)}")
+    print(relatorio_agendador())
+
+# --- Servidor de revisões: um único agendador para os jobs de todos os processos --- #
+# POST /revisar recebe {"codigo", "tenant", "classe", "formato", "especialistas", "arquivo",
+# "lote", "orcamento_lote"} e executa a revisão como um job daquele tenant/classe;
+# GET /filas mostra as esperas.
+FORMATOS_SERVIDOR = ("texto", "achados")
+MAXIMO_LOTES_SERVIDOR = 1000  # orçamentos de lote mantidos em memória (os mais antigos saem)
+
+class ServidorRevisao(BaseHTTPRequestHandler):
+    def _responder(self, status, corpo):
+        dados = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_GET(self):
+        if self.path != "/filas":
+            return self._responder(404, {"erro": f"caminho desconhecido: {self.path}"})
+        self._responder(200, {"relatorio": AGENDADOR.relatorio(), "filas": AGENDADOR.estatisticas()})
+
+    def do_POST(self):
+        if self.path != "/revisar":
+            return self._responder(404, {"erro": f"caminho desconhecido: {self.path}"})
+        try:
+            pedido = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self._responder(400, {"erro": "corpo não é um JSON válido"})
+        codigo = pedido.get("codigo")
+        tenant = pedido.get("tenant") or TENANT
+        classe = pedido.get("classe", "interativo")
+        formato = pedido.get("formato", "texto")
+        especialistas = pedido.get("especialistas")
+        if not isinstance(codigo, str) or not codigo:
+            return self._responder(400, {"erro": "informe o código em \"codigo\""})
+        if classe not in CLASSES_PRIORIDADE:
+            return self._responder(400, {"erro": f"classe inválida: {classe} (use {', '.join(CLASSES_PRIORIDADE)})"})
+        if formato not in FORMATOS_SERVIDOR:
+            return self._responder(400, {"erro": f"formato inválido: {formato} (use {', '.join(FORMATOS_SERVIDOR)})"})
+        if especialistas and not set(especialistas) <= set(ESPECIALISTAS):
+            return self._responder(400, {"erro": f"especialistas inválidos: {', '.join(set(especialistas) - set(ESPECIALISTAS))}"})
+        orcamento_lote = pedido.get("orcamento_lote") or 0
+        if not isinstance(orcamento_lote, int) or orcamento_lote < 0:
+            return self._responder(400, {"erro": "orcamento_lote deve ser um inteiro >= 0"})
+
+        inicio = time.monotonic()
+        try:
+            with job(tenant, classe), span("requisição", cat="servidor", tenant=tenant, classe=classe):
+                if formato == "achados":
+                    orcamento = self._orcamento_do_lote(pedido.get("lote"), orcamento_lote)
+                    resultado = {"achados": revisar_achados(pedido.get("arquivo") or "codigo", codigo, orcamento, especialistas)}
+                else:
+                    plano = planejar_revisao(codigo, especialistas=especialistas)
+                    resultado = {"plano": descrever_plano(plano), "resposta": revisar_com_plano(plano)}
+        except Exception as erro:
+            return self._responder(500, {"erro": f"{type(erro).__name__}: {erro}"})
+        resultado["duracao"] = time.monotonic() - inicio
+        self._responder(200, resultado)
+
+    # Cada lote (identificado pelo cliente) tem o próprio orçamento, com o limite do cliente;
+    # sem identificador o orçamento vale só para esta requisição
+    def _orcamento_do_lote(self, lote, limite):
+        if not lote:
+            return OrcamentoTokens(limite)
+        with self.server.lock_orcamentos:
+            orcamentos = self.server.orcamentos_lote
+            if lote not in orcamentos:
+                orcamentos[lote] = OrcamentoTokens(limite)
+                while len(orcamentos) > MAXIMO_LOTES_SERVIDOR:
+                    del orcamentos[next(iter(orcamentos))]
+            return orcamentos[lote]
+
+    # Silencia o log padrão de cada requisição
+    def log_message(self, formato, *args):
+        pass
+
+def iniciar_servidor(porta, host="127.0.0.1"):
+    servidor = ThreadingHTTPServer((host, porta), ServidorRevisao)
+    servidor.orcamentos_lote = {}
+    servidor.lock_orcamentos = threading.Lock()
+    print(f"🛰️ Servidor de revisões em http://{host}:{porta} (POST /revisar, GET /filas). Ctrl+C para sair.")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nServidor encerrado.\n{AGENDADOR.relatorio()}")
+    finally:
+        servidor.server_close()
+
+# Envia a revisão ao servidor com o tenant e a classe do job atual
+def revisar_no_servidor(codigo, formato="texto", especialistas=None, arquivo=None, lote=None, orcamento_lote=0):
+    tenant, classe = JOB_ATUAL.get()
+    pedido = {"codigo": codigo, "tenant": tenant, "classe": classe, "formato": formato,
+              "especialistas": especialistas, "arquivo": arquivo, "lote": lote, "orcamento_lote": orcamento_lote}
+    resposta = requests.post(f"{SERVIDOR_URL}/revisar", json=pedido, timeout=SERVIDOR_TIMEOUT)
+    if not resposta.ok:
+        raise RuntimeError(f"servidor respondeu {resposta.status_code}: {resposta.text.strip()}")
+    return resposta.json()
+
+# Esperas por classe: as do servidor, quando as revisões passam por ele
+def relatorio_agendador():
+    if SERVIDOR_URL:
+        return requests.get(f"{SERVIDOR_URL}/filas", timeout=SERVIDOR_TIMEOUT).json()["relatorio"]
+    return AGENDADOR.relatorio()
+
 print("🚀 Iniciando o Sistema de Feedback 🚀")
 
+# --- Servidor de revisões: atende os jobs de vários processos com um só agendador ---
+SERVIDOR_PORTA = os.getenv("SERVIDOR_PORTA")
+if SERVIDOR_PORTA:
+    iniciar_servidor(int(SERVIDOR_PORTA), os.getenv("SERVIDOR_HOST", "127.0.0.1"))
+    exit()
+
+# --- Revisão em lote: revisa todos os arquivos de LOTE_DIR ---
+LOTE_DIR = os.getenv("LOTE_DIR")
+if LOTE_DIR:
+    revisar_lote(
+        listar_arquivos(LOTE_DIR),
+        os.getenv("LOTE_SAIDA", "relatorio"),
+        formatos=[formato.strip() for formato in os.getenv("LOTE_FORMATOS", "jsonl,sarif,html").split(",")],
+        concorrencia=int(os.getenv("LOTE_CONCORRENCIA", "4")),
+    )
+    exit()
+
+# --- Modo watch: revisa automaticamente o que mudar em WATCH_DIR ---
+WATCH_DIR = os.getenv("WATCH_DIR")
+if WATCH_DIR:
+    modo_watch(
+        WATCH_DIR,
+        debounce=float(os.getenv("WATCH_DEBOUNCE", "0.5")),
+        concorrencia=int(os.getenv("WATCH_CONCORRENCIA", "4")),
+    )
+    exit()
+
+# --- Teste de carga em malha aberta: reproduz as chegadas gravadas em CARGA_CHEGADAS ---
+CARGA_CHEGADAS = os.getenv("CARGA_CHEGADAS")
+if CARGA_CHEGADAS:
+    gerar_carga_aberta(carregar_chegadas(CARGA_CHEGADAS), classe=os.getenv("CARGA_CLASSE"))
+    exit()
+
+# --- Teste de carga: revisa todos os arquivos de CARGA_DIR ---
+CARGA_DIR = os.getenv("CARGA_DIR")
+if CARGA_DIR:
+    codigos = []
+    for nome in sorted(os.listdir(CARGA_DIR)):
+        caminho = os.path.join(CARGA_DIR, nome)
+        if os.path.isfile(caminho):
+            with open(caminho, encoding="utf-8", errors="replace") as arquivo:
+                codigos.append(arquivo.read())
+    codigos *= int(os.getenv("CARGA_REPETICOES", "1"))
+    gerar_carga(
+        codigos,
+        concorrencia=int(os.getenv("CARGA_CONCORRENCIA", "4")),
+        classe=os.getenv("CARGA_CLASSE", "lote"),
+        modo=os.getenv("CARGA_MODO", "texto"),
+    )
+    exit()
+
 # --- Obter o input do Usuário ---
 codigo = input("Por favor, envie o código sobre o qual você deseja um feedback.")
 
@@ -791,5 +2118,10 @@ if not codigo:
 else:
     print(f"Maravilha! Vamos então ao feedback")
 
-resposta = agente_codereviewer(codigo)
+# Estima tokens e custo antes de enviar o código aos agentes
+plano = planejar_revisao(codigo)
+print(descrever_plano(plano))
+resposta = revisar_codigo(codigo) if SERVIDOR_URL else revisar_com_plano(plano)
 display(to_markdown(resposta))
+# Espera na fila por classe (com SERVIDOR_URL, a de todos os clientes do servidor)
+print(relatorio_agendador())